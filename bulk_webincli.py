@@ -2,12 +2,11 @@
 
 __author__ = "Nadim Rahman, Colman O'Cathail"
 
-import argparse, subprocess, sys
+import argparse, csv, functools, itertools, mmap, os, queue, re, shutil, subprocess, sys, threading
 import pandas as pd
-from joblib import Parallel, delayed
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from pathlib import Path
-import multiprocessing
 
 # Mapping the field names between the submitted user metadata spreadsheet and the manifest file fields
 spreadsheet_column_mapping = {
@@ -19,6 +18,57 @@ spreadsheet_column_mapping = {
     "library_description": "description",
 }
 
+# Manifest file fields as written to the manifest file, for each column of the spreadsheet which needs renaming
+manifest_field_mapping = {column: field.upper() for column, field in spreadsheet_column_mapping.items()}
+
+# Spreadsheet columns (as manifest file fields) holding uploaded data files, which are renamed according to the file type
+uploaded_file_fields = ("UPLOADED FILE 1", "UPLOADED FILE 2")
+
+# Mapping the extensions of uploaded data files to the manifest file field describing the file type
+file_type_mapping = {
+    ".fastq": "FASTQ",
+    ".fq": "FASTQ",
+    ".cram": "CRAM",
+    ".bam": "BAM",
+}
+
+# Extensions of data files (with an optional compression extension) removed from file names to obtain the manifest prefix
+data_file_extensions = re.compile(r"(?i)(\.(fastq|fq|bam|cram|fasta|fa|fna|fas|fsa|embl|flatfile|tab))?(\.(gz|bz2))?$")
+
+# Number of spreadsheet rows read and processed at a time, to bound memory usage for large spreadsheets
+spreadsheet_chunk_size = 10000
+
+# Message printed by Webin-CLI on a successful validation/submission, as bytes to search its raw output without decoding
+webin_cli_success = b"The submission has been validated successfully."
+
+# Options for the JVM running Webin-CLI. The serial garbage collector avoids each of the (possibly many parallel) JVMs
+# starting its own set of garbage collection threads sized to all CPU cores of the machine
+jvm_options = ["-XX:+UseSerialGC"]
+
+# Template of the arguments of the Webin-CLI command, with the slots filled in per run held as None
+webin_cli_command = [
+    "java",
+    *jvm_options,
+    "-jar",
+    None,
+    "-context",
+    None,
+    "-userName",
+    None,
+    "-password",
+    None,
+    "-inputDir",
+    None,
+    "-outputDir",
+    None,
+]
+webin_cli_jar_index = webin_cli_command.index("-jar") + 1
+webin_cli_context_index = webin_cli_command.index("-context") + 1
+webin_cli_username_index = webin_cli_command.index("-userName") + 1
+webin_cli_password_index = webin_cli_command.index("-password") + 1
+webin_cli_input_dir_index = webin_cli_command.index("-inputDir") + 1
+webin_cli_output_dir_index = webin_cli_command.index("-outputDir") + 1
+
 
 def get_args():
     """
@@ -98,7 +148,7 @@ def get_args():
     parser.add_argument(
         "-pc",
         "--parallel",
-        help="Run submissions in parallel and specify the number of cores/threads to use, maximum cores/threads=10",
+        help="Run submissions in parallel and specify the number of threads to use, maximum threads=10 or 4x the number of CPU cores, whichever is larger",
         type=int,
         required=False,
     )
@@ -116,15 +166,18 @@ def get_args():
     )
 
     args = parser.parse_args()
+    max_parallel = max(10, (os.cpu_count() or 1) * 4)  # Submissions mostly wait on Webin-CLI, so allow more threads than cores
 
     if args.mode is None:
         args.mode = "validate" # If no mode is provided, default to Webin-CLI validate mode
     if args.centerName is None:
         args.centerName = ""
+    if args.directory == "":
+        args.directory = "."
     if args.parallel is None:
         args.parallel = False
-    elif not 0 < args.parallel <= 10:
-        print("> ERROR: Invalid number of cores/threads provided. This value should be between 1 and 10 (inclusive).")
+    elif not 0 < args.parallel <= max_parallel:
+        print("> ERROR: Invalid number of cores/threads provided. This value should be between 1 and {} (inclusive).".format(max_parallel))
         sys.exit()
     if Path(args.webinCliPath).exists() is False:
         print("> ERROR: Cannot find the Webin CLI jar file. Please set the path to the Webin CLI jar file (--webinCliPath)")
@@ -132,28 +185,133 @@ def get_args():
     return args
 
 
+def metadata_columns(columns):
+    """
+    Select the columns of the spreadsheet which hold metadata
+    :param columns: Column names in the header of the spreadsheet
+    :return: List of column names, excluding unnamed columns (e.g. a saved index or empty trailing columns)
+    """
+    return [column for column in columns if not str(column).startswith("Unnamed:")]
+
+
+def read_delimited(spreadsheet_file, sep):
+    """
+    Read a delimited spreadsheet in chunks, keeping all values as strings to skip type inference
+    :param spreadsheet_file: Path to spreadsheet
+    :param sep: Delimiter used in the spreadsheet
+    :return: Iterator of chunks of the spreadsheet as data frames to be manipulated
+    """
+    columns = metadata_columns(pd.read_csv(spreadsheet_file, sep=sep, nrows=0).columns)
+    rows_read = 0  # Rows already read with pyarrow, skipped if the default parser has to take over
+    try:
+        import pyarrow.csv  # Optional, streams the spreadsheet through a multithreaded parser
+
+        reader = pyarrow.csv.open_csv(
+            spreadsheet_file,
+            read_options=pyarrow.csv.ReadOptions(use_threads=True, block_size=1 << 22),
+            parse_options=pyarrow.csv.ParseOptions(delimiter=sep),
+            convert_options=pyarrow.csv.ConvertOptions(
+                include_columns=columns,
+                column_types={column: pyarrow.string() for column in columns},
+                strings_can_be_null=True,
+            ),
+        )
+        for batch in reader:
+            yield batch.to_pandas()
+            rows_read += batch.num_rows
+        return
+    except ImportError:  # pyarrow is not available, use the default parser
+        pass
+    except pyarrow.ArrowException:  # pyarrow is stricter than the default parser (e.g. on rows with trailing empty cells left out), so continue with the latter
+        pass
+
+    for chunk in pd.read_csv(spreadsheet_file, header=0, sep=sep, index_col=False, dtype=str, usecols=columns, chunksize=spreadsheet_chunk_size):
+        if rows_read >= len(chunk):
+            rows_read -= len(chunk)
+            continue
+        yield chunk.iloc[rows_read:]
+        rows_read = 0
+
+
+def read_workbook(spreadsheet_file):
+    """
+    Read an Excel spreadsheet, keeping all values as strings to skip type inference. Excel files cannot be read in
+    chunks, so the whole spreadsheet is read at once - convert large spreadsheets to CSV/TSV to limit memory usage
+    :param spreadsheet_file: Path to spreadsheet
+    :return: Iterator of the spreadsheet as a single data frame to be manipulated
+    """
+    try:
+        columns = metadata_columns(pd.read_excel(spreadsheet_file, header=0, nrows=0, engine="calamine").columns)
+        spreadsheet = pd.read_excel(spreadsheet_file, header=0, index_col=False, dtype=str, usecols=columns, engine="calamine")
+    except (ImportError, ValueError):  # The calamine engine is not available, use the default engine
+        # Older pandas can neither read just the header (nrows) nor select columns by name, so drop unnamed columns after reading
+        spreadsheet = pd.read_excel(spreadsheet_file, header=0, dtype=str)
+        spreadsheet = spreadsheet[metadata_columns(spreadsheet.columns)]
+    yield spreadsheet
+
+
+def read_parquet(spreadsheet_file):
+    """
+    Read a Parquet spreadsheet in chunks, which stores column types so no type inference or parsing is needed
+    :param spreadsheet_file: Path to spreadsheet
+    :return: Iterator of chunks of the spreadsheet as data frames to be manipulated
+    """
+    import pyarrow.parquet  # Only required for Parquet spreadsheets
+
+    parquet_file = pyarrow.parquet.ParquetFile(spreadsheet_file)
+    columns = metadata_columns(parquet_file.schema_arrow.names)
+    for batch in parquet_file.iter_batches(batch_size=spreadsheet_chunk_size, columns=columns):
+        yield batch.to_pandas()
+
+
+# Functions to read the spreadsheet, for each supported file extension
+spreadsheet_readers = {
+    ".xlsx": read_workbook,
+    ".xls": read_workbook,
+    ".csv": lambda spreadsheet_file: read_delimited(spreadsheet_file, ","),
+    ".tsv": lambda spreadsheet_file: read_delimited(spreadsheet_file, "\t"),
+    ".txt": lambda spreadsheet_file: read_delimited(spreadsheet_file, "\t"),
+    ".parquet": read_parquet,
+}
+
+
 def spreadsheet_format(spreadsheet_file):
     """
     Open the spreadsheet depending on the file-type
     :param spreadsheet_file: Path to spreadsheet
-    :return: spreadsheet: Spreadsheet as a data frame to be manipulated
+    :return: spreadsheet: Iterator of chunks of the spreadsheet as data frames to be manipulated
     """
-    if spreadsheet_file.endswith(".xlsx") or spreadsheet_file.endswith(".xls"):
-        spreadsheet = pd.read_excel(spreadsheet_file, header=0, index_col=False)
-    elif spreadsheet_file.endswith(".csv"):
-        spreadsheet = pd.read_csv(spreadsheet_file, header=0, sep=",", index_col=False)
-    elif spreadsheet_file.endswith(".txt") or spreadsheet_file.endswith(".tsv"):
-        spreadsheet = pd.read_csv(spreadsheet_file, header=0, sep="\t", index_col=False)
+    reader = spreadsheet_readers.get(os.path.splitext(spreadsheet_file)[1].lower())
+    if reader is None:
+        print("> ERROR: Unsupported spreadsheet format. Please provide a .xlsx, .xls, .csv, .tsv, .txt or .parquet file (--spreadsheet)")
+        sys.exit()
+    spreadsheet = reader(spreadsheet_file)
     return spreadsheet
 
 
-def prepare_directories(directory):
+@functools.lru_cache(maxsize=None)
+def file_type_extensions(extensions):
     """
-    Prepare directories for processing of submissions
-    :param directory: Directory to be created
+    Obtain the manifest field for the extensions of a data file, cached as a spreadsheet only holds a few distinct ones
+    :param extensions: Lower case extensions of the data file name, without the leading dot (e.g. fastq.gz)
+    :return: field: Manifest field describing the file type (e.g. FASTQ), or None if no extension is recognised
     """
-    if not Path(directory).exists():
-        Path.mkdir(directory)
+    for extension in reversed(extensions.split(".")):  # Peel off extensions (e.g. a compression extension such as .gz) until the file type is found
+        field = file_type_mapping.get("." + extension)
+        if field is not None:
+            return field
+    return None
+
+
+def file_type_field(file_name, default):
+    """
+    Obtain the manifest field for an uploaded data file from its file extension
+    :param file_name: Name or path of the data file
+    :param default: Field to use if the file extension is not recognised
+    :return: field: Manifest field describing the file type (e.g. FASTQ)
+    """
+    extensions = os.path.basename(file_name).partition(".")[2]  # Everything after the first dot of the file name
+    return file_type_extensions(extensions.lower()) or default
 
 
 class GenerateManifests:
@@ -161,97 +319,168 @@ class GenerateManifests:
     Class object that coordinates the generation of manifest files
     """
 
-    def __init__(self, df, directory, context):
-        self.df = df
+    def __init__(self, spreadsheet, directory, context):
+        self.spreadsheet = spreadsheet  # Iterator of chunks of the spreadsheet as data frames
+        self.failed_files = []  # Manifest files which could not be generated
+        self.seen_manifests = {}  # Manifest files of all rows so far, to the (row, file name) they were generated from
+        self.rows_read = 0  # Number of spreadsheet rows processed so far, to report row numbers
         self.directory = directory
         self.context = context  # The context that Webin-CLI is to be used in (e.g. reads)
         self.manifest_dir = Path(directory) / "manifests"# Define directory to hold all manifest files
         self.submission_dir = Path(directory) / "submissions" # Define directory to hold all submission related files and sub-directories
 
-    def row_processing(self, row):
+        # Prepare manifest and submission directories
+        os.makedirs(self.manifest_dir, exist_ok=True)
+        os.makedirs(self.submission_dir, exist_ok=True)
+
+    def row_processing(self, df):
         """
-        Processing a row of data to obtain a dictionary of metadata in a row and a prefix for naming purposes
-        :param row: A row of metadata for submission
-        :return: manifest_file: Location and name of manifest file
+        Processing all rows of a chunk of data at once to obtain the metadata, manifest file names and file type fields.
+        Rows whose manifest file was already generated from an earlier row are skipped
+        :param df: Chunk of the spreadsheet as a data frame, with the manifest file fields as column names
+        :return: df: Dataframe of metadata with the manifest file fields accepted by Webin-CLI as column names, and N/A values as None
+        :return: manifests: List of (location and name of manifest file, manifest prefix) pairs, one per row
+        :return: file_fields: Dictionary of file fields to the list of their manifest field names, one per row
         """
-        row = row.dropna()  # Drop any fields with N/A in specified.
-        row_meta = row.to_dict() # Gets a row of metadata and keeps name of column as an index
-
-        if (self.context == "reads"):  # If reads are being submitted, get the name of the file to obtain a prefix
-            prefix_field = row_meta.get("uploaded file 1")
-        elif (self.context == "genome"):  # If an un-annotated genome is being submitted get the name of the fasta file to obtain a prefix
-            prefix_field = row_meta.get("fasta")
-        prefix = Path(prefix_field).stem  # Get just the name of the run without the file extensions (indexing 0 required as both are tuples)
-        manifest_file = Path(self.manifest_dir) / "Manifest_{}.txt".format(prefix)
-        return manifest_file
-
-    def create_manifest(self, metadata_content):
+        if self.context == "reads":  # If reads are being submitted, get the name of the file to obtain a prefix
+            prefix_field = "UPLOADED FILE 1"
+        else:  # Otherwise (e.g. an un-annotated genome) get the name of the fasta file to obtain a prefix
+            prefix_field = "FASTA"
+        file_names = df[prefix_field].astype(str).str.rsplit("/", n=1).str[-1]
+
+        manifests = []
+        unique_rows = []
+        for row_number, file_name in enumerate(file_names, start=self.rows_read + 2):  # Row numbers as shown in the spreadsheet, after the header
+            prefix = data_file_extensions.sub("", file_name)  # Get just the name of the run without the file extensions
+            manifest_file = Path(self.manifest_dir) / "Manifest_{}.txt".format(prefix)
+            if manifest_file in self.seen_manifests:  # Rows sharing a prefix would overwrite the same manifest file, so only keep the first one
+                first_row, first_file_name = self.seen_manifests[manifest_file]
+                print("> WARNING: Row {} ({}) and row {} ({}) both generate manifest file {}, only row {} will be submitted".format(
+                    first_row, first_file_name, row_number, file_name, manifest_file, first_row))
+                unique_rows.append(False)
+                continue
+            self.seen_manifests[manifest_file] = (row_number, file_name)
+            manifests.append((manifest_file, "Manifest_{}".format(prefix)))
+            unique_rows.append(True)
+        self.rows_read += len(unique_rows)
+        if not all(unique_rows):
+            df = df[unique_rows].copy()
+
+        if "INSERT_SIZE" in df:
+            df["INSERT_SIZE"] = pd.to_numeric(df["INSERT_SIZE"].dropna()).astype(int).astype(object).reindex(df.index)
+
+        file_fields = {}
+        for column in uploaded_file_fields:  # Specify the appropriate file type
+            if column in df:
+                file_fields[column] = [file_type_field(str(value), column) for value in df[column]]
+
+        df = df.astype(object).where(df.notna(), None)  # Mark all N/A values as None for the whole chunk at once
+        return df, manifests, file_fields
+
+    def create_manifest(self, columns, row, file_fields):
         """
         Create manifest file from metadata
-        :param metadata_content: Dictionary of metadata to be converted into a dataframe before submission
-        :return: manifest_content: Dataframe of the manifest file for submission
+        :param columns: List of manifest file fields, in the order of the values in the row
+        :param row: Tuple of metadata values to be converted into manifest fields before submission
+        :param file_fields: Dictionary of file fields to their manifest field names for this row
+        :return: manifest_content: List of (field, value) pairs of the manifest file for submission
         """
-        first_col = []
-        second_col = []
-
-        for item in metadata_content.items():
-            field = item[0]
-            value = item[1]
-            if field in spreadsheet_column_mapping:
-                field = spreadsheet_column_mapping.get(field)  # Convert the name of the field to one that is accepted by Webin-CLI
-            elif field == "insert_size":
-                value = int(value)
-            elif (field == "uploaded file 1" or "uploaded file 2"):  # Specify the appropriate file type
-                if ".fastq" in str(value) or ".fq" in str(value):
-                    field = "fastq"
-                elif ".cram" in str(value):
-                    field = "cram"
-                elif ".bam" in str(value):
-                    field = "bam"
-            field = field.upper()
-            first_col.append(str(field))
-            second_col.append(str(value))
-        manifest_content = {"field": first_col, "value": second_col}
-        manifest_content = pd.DataFrame.from_dict(manifest_content)
+        manifest_content = [None] * len(columns)  # Allocate a pair per field up front, trimmed once filled
+        field_count = 0
+
+        for field, value in zip(columns, row):
+            if value is None:  # Skip any fields with N/A specified
+                continue
+            field = file_fields.get(field, field)
+            manifest_content[field_count] = (field, value)
+            field_count += 1
+        del manifest_content[field_count:]
         return manifest_content
 
-    def write_manifests(self, manifest_file, manifest_content):
+    def write_manifests(self, manifest, manifest_content):
         """
         Write out the manifest file
-        :param manifest_file: Path and name of manifest file
-        :param manifest_content: Content of the manifest file
-        :return: successful: List of successfully processed file(s)
-        :return: failed: List of unsuccessfully processed file(s)
+        :param manifest: Pair of the path and name of manifest file and the manifest prefix
+        :param manifest_content: Content of the manifest file, as (field, value) pairs
+        :return: successful: List of successfully processed file(s), as (manifest file, manifest prefix) pairs
+        :return: failed: List of unsuccessfully processed file(s), as (manifest file, manifest prefix) pairs
         """
-        # Prepare manifest and submission directories
-        prepare_directories(self.manifest_dir)
-        prepare_directories(self.submission_dir)
-
         successful = []
         failed = []
 
         try:
-            out = manifest_content.to_csv(manifest_file, sep="\t", index=False, header=False)
-            successful.append(manifest_file)
+            with open(manifest[0], "w", buffering=64 * 1024) as manifest_file:
+                csv.writer(manifest_file, delimiter="\t", lineterminator="\n").writerows(manifest_content)
+            successful.append(manifest)
         except Exception as e:
-            failed.append(manifest_file)
+            failed.append(manifest)
             print("> ERROR during creation of manifest file: " + str(e))
         return successful, failed
 
-    def generate_manifests(self):
+    def process_row(self, manifest, columns, row, file_fields):
         """
-        Coordinate the generation of the manifest files for Webin-CLI submissions
-        :return:
+        Create and write out the manifest file for a row of metadata
+        :param manifest: Pair of the path and name of manifest file and the manifest prefix
+        :param columns: List of manifest file fields, in the order of the values in the row
+        :param row: Tuple of metadata values for submission
+        :param file_fields: Dictionary of file fields to their manifest field names for this row
+        :return: successful: List of successfully processed file(s)
+        :return: failed: List of unsuccessfully processed file(s)
+        """
+        manifest_content = self.create_manifest(columns, row, file_fields)  # Create the fields and values of the manifest file content
+        return self.write_manifests(manifest, manifest_content)  # Write the fields and values to a file to generate a manifest file
+
+    def generate_manifests(self, n_jobs=1):
+        """
+        Coordinate the generation of the manifest files for Webin-CLI submissions, yielding them chunk by chunk so that
+        they can be submitted while the rest of the spreadsheet is processed. Unsuccessfully processed file(s) are
+        collected in self.failed_files
+        :param n_jobs: Number of threads to generate the manifest files with
+        :return: Iterator of successfully processed file(s), as (manifest file, manifest prefix) pairs
         """
-        all_successful_files = []
-        all_failed_files = []
-        for index, row in self.df.iterrows():
-            manifest_file = self.row_processing(row)  # Process the row of data - define some variables and files, etc.
-            manifest_content = self.create_manifest(row)  # Create a dataframe of the manifest file content
-            successful_files, failed_files = self.write_manifests(manifest_file, manifest_content)  # Write the dataframe to a file to generate a manifest file
-            all_successful_files.append(successful_files)
-            all_failed_files.append(failed_files)
-        return all_successful_files, all_failed_files
+        columns = None
+        with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+            for chunk in self.spreadsheet:
+                if columns is None:  # Convert the names of the fields to the (upper case) ones that are accepted by Webin-CLI, once per spreadsheet
+                    columns = [manifest_field_mapping.get(column) or column.upper() for column in chunk.columns]
+                chunk.columns = columns
+                df, manifests, file_fields = self.row_processing(chunk)  # Process all rows of the chunk - define some variables and files, etc.
+                results = executor.map(
+                    self.process_row,
+                    manifests,
+                    itertools.repeat(columns),
+                    df.itertuples(index=False, name=None),
+                    ({column: fields[index] for column, fields in file_fields.items()} for index in range(len(manifests))),
+                )
+                for successful_files, failed_files in results:
+                    yield from successful_files
+                    self.failed_files += failed_files
+
+
+def construct_base_command(args):
+    """
+    Construct the part of the Webin-CLI command which is shared by all submissions
+    :param args: Arguments provided to the tool
+    :return: command: List of arguments of the command, without the manifest file
+    """
+    submission_dir = Path(args.directory) / "submissions"  # Directory to hold all submission related files and sub-directories
+    command = list(webin_cli_command)
+    command[0] = shutil.which("java") or "java"  # Resolve Java once, rather than searching the PATH at every launch
+    command[webin_cli_jar_index] = args.webinCliPath
+    command[webin_cli_context_index] = args.geneticContext
+    command[webin_cli_username_index] = args.username
+    command[webin_cli_password_index] = args.password
+    command[webin_cli_input_dir_index] = args.directory
+    command[webin_cli_output_dir_index] = str(submission_dir)
+    if args.centerName != "":
+        command += ["-centerName", args.centerName]
+    command.append("-{}".format(args.mode))
+
+    if args.test is True:
+        command.append("-test")
+    if args.ascp is True:
+        command.append("-ascp")
+    return command
 
 
 class SubmissionWebinCLI:
@@ -259,138 +488,151 @@ class SubmissionWebinCLI:
     Class object to submit or validate using Webin-CLI
     """
 
-    def __init__(self, file, args):
+    def __init__(self, file, manifest_prefix, base_command):
         self.file = file
-        self.args = args
-        self.submission_dir = Path(self.args.directory) / "submissions"  # Define directory to hold all submission related files and sub-directories
+        self.manifest_prefix = manifest_prefix  # Name of the manifest file without the extension, used to name report files
+        self.base_command = base_command  # Arguments of the command shared by all submissions
 
     def file_prep(self):
         """
         Prepare and define files
         :return: output_dir: Directory to house report files.
         :return: log_path_err, log_path_out: Directory and file to store error and output
-        :return: all_error_runs: File which will contain IDs of failed submissions
         """
-        self.manifest_prefix = Path(self.file).stem
-        # self.manifest_prefix = os.path.splitext(os.path.basename(self.file))[0]
-
-        if self.args.directory == "":
-            self.args.directory = "."
-
-        self.output_dir = Path(self.args.directory) / "manifests" / f"{self.manifest_prefix}-report"
-        self.log_path_err = Path(self.output_dir) / f"{self.manifest_prefix}.err"
-        self.log_path_out = Path(self.output_dir) / f"{self.manifest_prefix}.out"
+        self.output_dir = Path(self.file).with_name(f"{self.manifest_prefix}-report")  # Alongside the manifest file
+        self.log_path_err = self.output_dir / f"{self.manifest_prefix}.err"
+        self.log_path_out = self.output_dir / f"{self.manifest_prefix}.out"
         print(self.log_path_err, self.log_path_out)
-
-        self.all_error_runs = Path(self.args.directory) / "failed_validation.txt"
+        os.makedirs(self.output_dir, exist_ok=True)
 
     def construct_command(self):
         """
         Construct the command that is to be run for submission
-        :return: command: String with command to be run for submission
+        :return: command: List of arguments of the command to be run for submission
         """
-        if self.args.centerName == "":
-            command = "mkdir -p {} && java -jar {} -context {} -userName {} -password {} -manifest {} -inputDir {} -outputDir {} -{}".format(
-                self.output_dir,
-                self.args.webinCliPath,
-                self.args.geneticContext,
-                self.args.username,
-                self.args.password,
-                self.file,
-                self.args.directory,
-                self.submission_dir,
-                self.args.mode,
-            )
-        else:
-            command = "mkdir -p {} && java -jar {} -context {} -userName {} -password {} -manifest {} -inputDir {} -outputDir {} -centerName '{}' -{}".format(
-                self.output_dir,
-                self.args.webinCliPath,
-                self.args.geneticContext,
-                self.args.username,
-                self.args.password,
-                self.file,
-                self.args.directory,
-                self.submission_dir,
-                self.args.centerName,
-                self.args.mode,
-            )
-
-        if self.args.test is True:
-            command = command + " -test"
-        if self.args.ascp is True:
-            command = command + " -ascp"
+        command = self.base_command + ["-manifest", str(self.file)]
         return command
 
     def run_command(self, command):
         """
-        Run the command
-        :param command: Constructed command to be run
-        :return: Standard output and error from the run command
+        Run the command, with its output written straight to the report files
+        :param command: Constructed command to be run, as a list of arguments
+        :return: successful: Whether the run command reported a successful validation
         """
         print("*" * 100)
-        print("""Command to be executed:{}""".format(command))
+        print("""Command to be executed:{}""".format(" ".join(command)))
         print("*" * 100)
-        p = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True)
-        out, err = p.communicate()
-        return out, err
-
-    def post_process(self, output, error, timestamp):
+        with open(self.log_path_err, "w") as err_file, open(self.log_path_out, "w") as out_file:
+            out_file.write("*" * 100 + "\n")
+            out_file.flush()  # Write the header before Webin-CLI appends its output to the file
+            p = subprocess.Popen(command, stdout=out_file, stderr=err_file)
+            return_code = p.wait()
+
+        # Scan the output for the success message without reading it into memory
+        with open(self.log_path_out, "rb") as out_file, mmap.mmap(out_file.fileno(), 0, access=mmap.ACCESS_READ) as output:
+            successful = return_code == 0 and output.find(webin_cli_success) != -1  # A failed upload exits non-zero after validation succeeded
+        return successful
+
+    def post_process(self, successful, timestamp):
         """
         Post process the output of the run command
-        :param output: The standard output from the run command (.stdout)
-        :param error: The standard error from the run command (.stderr)
+        :param successful: Whether the run command reported a successful validation
         :param timestamp: The timestamp of the run command
+        :return: error_record: Record of the failed submission for the failed submissions file, None if successful
         """
-        with open(self.log_path_err, "w") as err_file, open(self.log_path_out, "w") as out_file, open(self.all_error_runs, "a") as all_errors:
-            if error:
-                err_file.write(str(error.decode("UTF-8")))
-                err_file.write("[{}] VALIDATION FAILED - {}\n".format(timestamp, self.file))
-                all_errors.write("*" * 100 + "\n")
-                all_errors.write("[{}] {}\n".format(timestamp, self.manifest_prefix))
-                all_errors.write(str(error.decode("UTF-8")) + "\n")
-                all_errors.write("*" * 100 + "\n")
-
-            if output:
-                if "The submission has been validated successfully." in str(output):
-                    out_file.write("*" * 100 + "\n")
-                    out_file.write(str(output.decode("UTF-8")))
-                    out_file.write("[{}] VALIDATION SUCCESSFUL - {}\n".format(timestamp, self.file))
-                    out_file.write("*" * 100)
-                else:
-                    err_file.write(str(output.decode("UTF-8")))
-                    err_file.write("[{}] VALIDATION FAILED - {}\n".format(timestamp, self.file))
-                    all_errors.write("*" * 100 + "\n")
-                    all_errors.write("[{}] {}\n".format(timestamp, self.manifest_prefix))
-                    all_errors.write(str(output.decode("UTF-8")))
-                    all_errors.write("*" * 100 + "\n")
-
-
-def submit_validate(file, args):
+        if successful:
+            with open(self.log_path_out, "a") as out_file:
+                out_file.write("[{}] VALIDATION SUCCESSFUL - {}\n".format(timestamp, self.file))
+                out_file.write("*" * 100)
+            return None
+
+        # Report the output of a failed run in the error file, leaving the output file empty
+        with open(self.log_path_out, "r+") as out_file, open(self.log_path_err, "a") as err_file:
+            out_file.readline()  # Skip the header, which is only kept for successful runs
+            shutil.copyfileobj(out_file, err_file)
+            out_file.truncate(0)
+            err_file.write("[{}] VALIDATION FAILED - {}\n".format(timestamp, self.file))
+        with open(self.log_path_err) as err_file:
+            error_record = "*" * 100 + "\n"
+            error_record += "[{}] {}\n".format(timestamp, self.manifest_prefix)
+            error_record += err_file.read()
+            error_record += "*" * 100 + "\n"
+        return error_record
+
+
+def submit_queued(manifest_queue, stop_submissions, base_command, all_errors_fd):
+    """
+    Submit or validate manifest files taken from a queue until a None sentinel is received or submissions are stopped
+    :param manifest_queue: Queue of (manifest file, manifest prefix) pairs to be submitted
+    :param stop_submissions: Event set when the tool is interrupted, after which no further manifest files are submitted
+    :param base_command: Arguments of the Webin-CLI command shared by all submissions
+    :param all_errors_fd: File descriptor, opened for appending, of the file which records failed submissions
+    """
+    while True:
+        manifest = manifest_queue.get()
+        if manifest is None or stop_submissions.is_set():
+            break
+        try:
+            submit_validate(*manifest, base_command, all_errors_fd)
+        except Exception as e:  # Keep consuming, so that the manifest generation never blocks on a full queue
+            print("> ERROR during submission of manifest file {}: {}".format(manifest[0], str(e)))
+
+
+def submit_validate(file, manifest_prefix, base_command, all_errors_fd):
     """
     Coordinate the submission or validation using Webin-CLI
     :param file: File that has been successfully pre-processed - manifest file had been generated successfully
-    :param args: Arguments provided to the tool
+    :param manifest_prefix: Name of the manifest file without the extension
+    :param base_command: Arguments of the Webin-CLI command shared by all submissions
+    :param all_errors_fd: File descriptor, opened for appending, of the file which records failed submissions
     """
-    webincli_process = SubmissionWebinCLI(file, args)
+    webincli_process = SubmissionWebinCLI(file, manifest_prefix, base_command)
     now = datetime.now()
     webincli_process.file_prep()  # Define files used during the submission process
     command = webincli_process.construct_command()  # Create the command to be processed
-    out, err = webincli_process.run_command(command)  # Run the command and obtain output and error
-    webincli_process.post_process(out, err, now)  # Post-process - save output accordingly
+    successful = webincli_process.run_command(command)  # Run the command, saving its output and error
+    error_record = webincli_process.post_process(successful, now)  # Post-process - record the outcome accordingly
+    if error_record is not None:
+        os.write(all_errors_fd, error_record.encode("UTF-8"))  # A single append is atomic, so parallel submissions need no lock
 
 
 if __name__ == "__main__":
     args = get_args()  # Get arguments provided to the tool
-    to_process = spreadsheet_format(args.spreadsheet)  # Create a dataframe of data to be processed (submitted or validated)
+    to_process = spreadsheet_format(args.spreadsheet)  # Create an iterator of dataframe chunks of data to be processed (submitted or validated)
 
-    # Generate the manifest files
     create_manifests = GenerateManifests(to_process, args.directory, args.geneticContext)
-    processed, failed = create_manifests.generate_manifests()
-
-    # Webin-CLI submission
+    base_command = construct_base_command(args)  # The command only differs in the manifest file between submissions
+    all_error_runs = Path(args.directory) / "failed_validation.txt"  # File which will contain IDs of failed submissions
     if args.parallel is not False:
         print("> Number of cores to use: {}".format(args.parallel))
-        Parallel(n_jobs=args.parallel)(delayed(submit_validate)(process[0], args) for process in processed)
-    else:
-        for process in processed:
-            submit_validate(process[0], args)
+    workers = args.parallel or 1
+
+    # Generate the manifest files and submit them with Webin-CLI as they are generated
+    manifest_queue = queue.Queue(maxsize=workers * 2)
+    stop_submissions = threading.Event()
+    all_errors_fd = os.open(all_error_runs, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)  # Opened once and shared by all submissions
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:  # Threads suffice as each job waits on a Webin-CLI process
+            for _ in range(workers):
+                executor.submit(submit_queued, manifest_queue, stop_submissions, base_command, all_errors_fd)
+            try:
+                for manifest in create_manifests.generate_manifests(workers):
+                    manifest_queue.put(manifest)
+            except BaseException:  # Interrupted (e.g. by Ctrl-C), so do not submit the manifest files still waiting in the queue
+                stop_submissions.set()
+                while True:
+                    try:
+                        manifest_queue.get_nowait()
+                    except queue.Empty:
+                        break
+                raise
+            finally:
+                for _ in range(workers):
+                    manifest_queue.put(None)  # Signal each submission thread that no more manifest files will follow
+    finally:
+        os.close(all_errors_fd)
+
+    if create_manifests.failed_files:
+        print("> ERROR: {} manifest file(s) could not be generated and were not submitted:".format(len(create_manifests.failed_files)))
+        for manifest_file, manifest_prefix in create_manifests.failed_files:
+            print(manifest_file)